@@ -5,15 +5,73 @@
 import os
 import sys
 import re                       # for regular expressions
+import bisect
+from collections import defaultdict
+import gzip
+import io
 import cPickle as pickle
 
 from tt_log import logger
 
-VERSION = '20150611.01'
+VERSION = '20261015.01'
 logger.debug('version %s loaded' % VERSION)
 
+# Attribute patterns for standard (GENCODE-like) annotation files.
+
+# It's tempting to fuse these into a single alternation and pick up
+# all the fields in one findall pass. Don't: each of these patterns
+# starts with a literal, which the regex engine scans for very
+# quickly, and three such searches on a GENCODE exon line take less
+# than half the time of one findall with an alternation.
+
+regexGene = re.compile ('gene_name \"([^\"]+)\"\;')
+regexTran = re.compile ('transcript_name \"([^\"]+)\"\;')
+regexTID  = re.compile ('transcript_id \"([^\"]+)\"\;')
+regexExon = re.compile ('exon_number \"?(\d+)\"?\;')         # some files have quotes around exon number, some don't
+
+# Attribute patterns for alternative format annotation files.
+
+regexAltGene = re.compile ('gene_name \"*([^\"]+)\"*\;')
+regexAltGID  = re.compile ('gene_id \"*([^\"]+)\"*\;')
+regexAltTran = re.compile ('transcript_name \"*([^\"]+)\"*\;')
+regexAltTID  = re.compile ('transcript_id \"*([^\"]+)\"*\;')
+regexAltExon = re.compile ('exon_number \"*(\d+)\"*\;')
+
+BUFSIZE = 1024 * 1024           # read buffer size for annotation files
+
+# Entry types we pay attention to. Anything else (CDS, UTR, etc.)
+# is skipped as soon as its type is known.
+
+TYPES_STANDARD = frozenset(['gene', 'transcript', 'exon', 'start_codon', 'stop_codon'])
+TYPES_ALT      = frozenset(['exon', 'start_codon', 'stop_codon'])
+
+def setSlotState (obj, state):
+    '''
+    Restore an unpickled object which has __slots__ from its pickled
+    state, which may have been saved before the class had __slots__.
+    For use by __setstate__ methods.
+    '''
+
+    # Pickling protocol 2 gives us (None, slots dict). Older
+    # pickles give us the contents of the object's __dict__.
+
+    if isinstance(state, tuple):
+        state = state[1]
+    for slot, value in state.iteritems():
+        setattr (obj, slot, value)
+
 class Annotation (object):
 
+    # There are a lot of these (well over a million for GENCODE), so
+    # don't give each one a __dict__. Only transcripts use ID, length,
+    # startcodon and stopcodon, and only exons use polyAs. Those slots
+    # stay unset otherwise, so hasattr still tells us whether they're
+    # present. The coords slot is filled in by childCoords.
+
+    __slots__ = ('start', 'end', 'strand', 'name', 'children',
+                 'ID', 'length', 'startcodon', 'stopcodon', 'polyAs',
+                 'coords')
+
     def __init__ (self, start, end, strand, name):
         '''Annotation file data about a gene, transcript, or exon.'''
 
@@ -31,6 +89,14 @@ class Annotation (object):
         '''Support indexing for an Annotation object by returning len(children).'''
         return len(self.children)
 
+    def __lt__ (self, other):
+        '''Support ordering of Annotation objects by start position.'''
+        return self.start < other.start
+
+    def __setstate__ (self, state):
+        '''Support unpickling, including pickles made before Annotation had __slots__.'''
+        setSlotState (self, state)
+
     def updateStartEnd (self, start, end):
         '''
         With alternative format GTF annotation files, the start and
@@ -53,13 +119,13 @@ class Annotation (object):
         the incoming data.
         '''
 
-        # The sort at the bottom of this block looks a little
-        # scary. But the 500 sorts required to process the
-        # out-of-sequence entries on chrY in the GENCODE19 gtf file
-        # take only ~150 msec. It would be nice to sort only once, at
-        # the end -- but the Annotation object doesn't know when the
-        # end has arrived. It has to keep itself consistent after
-        # every call to addChild.
+        # Out-of-sequence entries (e.g., ~500 of them on chrY in the
+        # GENCODE19 gtf file) are slotted into place with a binary
+        # search. insort_right puts the new child after any existing
+        # children with the same start, which is what the stable sort
+        # we used to do here did. The Annotation object doesn't know
+        # when the end of the data has arrived, so it has to keep
+        # itself consistent after every call to addChild.
 
         if self.children == None:
             self.children = [child]
@@ -70,8 +136,7 @@ class Annotation (object):
         else:
 ####            raise RuntimeError('out of sequence: %s' % child.name)
 ####            logger.debug('out of sequence: %s' % child.name)
-            self.children.append(child)
-            self.children.sort(key=lambda x: x.start)
+            bisect.insort_right (self.children, child)        # uses __lt__, i.e., start position
             
     def getChildren (self):
         '''Generator function to return children, which are Annotation objects themselves, one by one.'''
@@ -87,10 +152,37 @@ class Annotation (object):
             return 0
         return len(self.children)
 
+    def childCoords (self):
+        '''
+        Return parallel lists of the start and end coordinates of
+        this entry's children.
+        '''
+
+        # matchAnnot compares every isoform against the exon
+        # coordinates of each transcript it overlaps, so a transcript
+        # can be asked for these many thousands of times. They don't
+        # change once the annotations are loaded, so compute them the
+        # first time and keep them. The length check covers the (load
+        # time) case of children added after the lists were made.
+
+        try:
+            coords = self.coords
+        except AttributeError:           # never computed, or an older pickle
+            coords = None
+
+        numChildren = self.numChildren()
+        if coords is None or len(coords[0]) != numChildren:
+            children = self.children or []
+            coords = ( [child.start for child in children],
+                       [child.end   for child in children] )
+            self.coords = coords
+
+        return coords
+
 
 class AnnotationList (object):
     
-    def __init__ (self, filename, altFormat=False):
+    def __init__ (self, filename, altFormat=False, strict=False):
         '''
         self.annot is a dict keyed by chr.  Each dict entry is a
         top-level Annotation object for that chr. An Annotation object
@@ -120,7 +212,14 @@ class AnnotationList (object):
         # Note that there is a thrid way to create an AnnotationList
         # object: See AnnotationList.fromPickle below.
 
+        # In a standard format file, transcript and exon entries
+        # repeat the gene and transcript names of the entries they
+        # belong to. In a well-formed file those always agree, so
+        # checking them costs time on every exon and buys nothing.
+        # Pass strict=True to check them anyway.
+
         self.filename = filename
+        self.strict   = strict
         self.annot    = dict()       # this is the stuff! key=chr value=top-level Annotation object for chr
         self.geneDict = None         # lookup table by gene name (created and cached when needed)
 
@@ -129,29 +228,34 @@ class AnnotationList (object):
         else:
             self.initFromAlt()
 
+    def openFile (self):
+        '''Open the annotation file for reading. A .gz file is decompressed on the fly.'''
+
+        # GENCODE and Ensembl distribute their gtf files gzipped. Reading
+        # them directly saves a separate gunzip step. GzipFile's own
+        # line iteration is slow, hence the BufferedReader wrapper.
+
+        if self.filename.endswith('.gz'):
+            return io.BufferedReader (gzip.open (self.filename, 'rb'), BUFSIZE)
+        else:
+            return open (self.filename, 'rb', BUFSIZE)
+
     def initFromStandard (self):
 
         logger.debug('reading annotations in standard format from %s' % self.filename)
 
-        regexGene = re.compile ('gene_name \"([^\"]+)\"\;')
-        regexTran = re.compile ('transcript_name \"([^\"]+)\"\;')
-        regexTID  = re.compile ('transcript_id \"([^\"]+)\"\;')
-        regexExon = re.compile ('exon_number \"?(\d+)\"?\;')         # some files have quotes around exon number, some don't
-
         numGenes = 0
         numTrans = 0
         numExons = 0
 
-        handle = open (self.filename, 'r')
+        handle = self.openFile()
 
         for line in handle:
 
             if line.startswith('#'):               # skip comment line
                 continue
 
-            chr, source, type, start, end, score, strand, frame, attrs = line.strip().split('\t')
-            start = int(start)
-            end   = int(end)
+            chr, source, type, start, end, score, strand, frame, attrs = line.rstrip('\r\n').split('\t', 8)
 
 #           chrEnt = self.annot.setdefault (chr, Annotation(0, 0, '+', chr))    # dummy top entry for chr
 #               Used to do this as above. But that creates an Annotation object
@@ -161,22 +265,29 @@ class AnnotationList (object):
                 self.annot[chr] = Annotation(0, 0, '+', chr)       # dummy top entry for chr
             chrEnt = self.annot[chr]
 
+            if type not in TYPES_STANDARD:         # skip CDS, UTR, etc.
+                continue
+
+            start = int(start)
+            end   = int(end)
+
             if type == 'gene':
 
                 numGenes += 1
-                geneName = re.search(regexGene, attrs).group(1)
+                geneName = regexGene.search(attrs).group(1)
                 geneEnt = Annotation (start, end, strand, geneName)
                 chrEnt.addChild(geneEnt)
 
             elif type == 'transcript':
 
                 numTrans += 1
-                geneName = re.search(regexGene, attrs).group(1)
-                tranName = re.search(regexTran, attrs).group(1)
-                tranID   = re.search(regexTID,  attrs).group(1)       # transcript id looks like: ENST00000456328.2
+                tranName = regexTran.search(attrs).group(1)
+                tranID   = regexTID.search(attrs).group(1)       # transcript id looks like: ENST00000456328.2
 
-                if geneName != geneEnt.name:
-                    raise RuntimeError ('gene name %s != %s in transcript %s' % (geneName, geneEnt.name, tranName))
+                if self.strict:
+                    geneName = regexGene.search(attrs).group(1)
+                    if geneName != geneEnt.name:
+                        raise RuntimeError ('gene name %s != %s in transcript %s' % (geneName, geneEnt.name, tranName))
 
                 tranEnt = Annotation (start, end, strand, tranName)
                 tranEnt.ID     = tranID                               # only transcripts have ID and length attributes
@@ -186,16 +297,17 @@ class AnnotationList (object):
             elif type == 'exon':
 
                 numExons += 1
-                geneName = re.search(regexGene, attrs).group(1)
-                tranName = re.search(regexTran, attrs).group(1)
-                exonNum  = int(re.search(regexExon, attrs).group(1))
+                tranName = regexTran.search(attrs).group(1)
+                exonNum  = int(regexExon.search(attrs).group(1))
                 exonName = '%s/%d' % (tranName, exonNum)     # exons don't have names: make one up
 
-                if geneName != geneEnt.name:
-                    raise RuntimeError ('gene name %s != %s in transcript %s' % (geneName, geneEnt.name, tranName))
-                if tranName != tranEnt.name:
-                    raise RuntimeError ('transcript name %s != %s in exon %d' % (tranName, tranEnt.name, exonNum))
-                if exonNum  != tranEnt.numChildren() + 1:
+                if self.strict:
+                    geneName = regexGene.search(attrs).group(1)
+                    if geneName != geneEnt.name:
+                        raise RuntimeError ('gene name %s != %s in transcript %s' % (geneName, geneEnt.name, tranName))
+                    if tranName != tranEnt.name:
+                        raise RuntimeError ('transcript name %s != %s in exon %d' % (tranName, tranEnt.name, exonNum))
+                if exonNum  != tranEnt.numChildren() + 1:         # downstream code relies on exon order, so always check this
                     raise RuntimeError ('transcript name %s exons out of sequence' % (tranName))
 
                 tranEnt.length += end - start + 1            # add this exon to total transcript length
@@ -226,12 +338,6 @@ class AnnotationList (object):
 
         logger.debug('reading annotations in alternate format from %s' % self.filename)
 
-        regexGene = re.compile ('gene_name \"*([^\"]+)\"*\;')
-        regexGID  = re.compile ('gene_id \"*([^\"]+)\"*\;')
-        regexTran = re.compile ('transcript_name \"*([^\"]+)\"*\;')
-        regexTID  = re.compile ('transcript_id \"*([^\"]+)\"*\;')
-        regexExon = re.compile ('exon_number \"*(\d+)\"*\;')         # some files have quotes around exon number, some don't
-
         numGenes = 0
         numTrans = 0
         numExons = 0
@@ -239,26 +345,30 @@ class AnnotationList (object):
         geneEnt = None
         tranEnt = None
 
-        handle = open (self.filename, 'r')
+        handle = self.openFile()
 
         for line in handle:
 
             if line.startswith('#'):               # skip comment line
                 continue
 
-            chr, source, type, start, end, score, strand, frame, attrs = line.strip().split('\t')
-            start = int(start)
-            end   = int(end)
+            chr, source, type, start, end, score, strand, frame, attrs = line.rstrip('\r\n').split('\t', 8)
 
             if chr not in self.annot:
                 self.annot[chr] = Annotation(0, 0, '+', chr)       # dummy top entry for chr
             chrEnt = self.annot[chr]
 
+            if type not in TYPES_ALT:              # skip CDS, UTR, etc.
+                continue
+
+            start = int(start)
+            end   = int(end)
+
             if type == 'exon':
 
-                match = re.search(regexGene, attrs)
+                match = regexAltGene.search(attrs)
                 if match is None:
-                    match = re.search(regexGID, attrs)             # if no gene_name field, try gene_id
+                    match = regexAltGID.search(attrs)             # if no gene_name field, try gene_id
                     if match is None:
                         raise RuntimeError ('no gene_name/gene_id field in %s' % line)
                 geneName = match.group(1)
@@ -273,8 +383,8 @@ class AnnotationList (object):
                 # Capture transcript_name and transcript_id if they
                 # both exist, otherwise take whichever we find.
 
-                matchName = re.search(regexTran, attrs)
-                matchID   = re.search(regexTID,  attrs)
+                matchName = regexAltTran.search(attrs)
+                matchID   = regexAltTID.search(attrs)
                 if matchID is not None:
                     tranID   = matchID.group(1)
                     tranName = matchName.group(1) if matchName is not None else tranID
@@ -295,7 +405,7 @@ class AnnotationList (object):
 
                 tranEnt.length += end - start + 1             # add this exon to total transcript length
                     
-                matchExon = re.search(regexExon, attrs)
+                matchExon = regexAltExon.search(attrs)
                 if matchExon is not None:
                     exonNum = int(matchExon.group(1))
                     if exonNum != tranEnt.numChildren() + 1:
@@ -316,6 +426,16 @@ class AnnotationList (object):
 
         handle.close()
 
+        # Gene start coordinates may have moved down (see
+        # updateStartEnd) since the genes were added to their chr's
+        # list of children. AnnotationIndex relies on that list being
+        # in start order, so now that we have all the data, sort it
+        # once.
+
+        for chrEnt in self.annot.itervalues():
+            if chrEnt.children is not None:
+                chrEnt.children.sort(key=lambda x: x.start)
+
         logger.debug('read %d genes, %d transcripts, %d exons' % (numGenes, numTrans, numExons))
 
         return
@@ -326,7 +446,7 @@ class AnnotationList (object):
 
         logger.debug('reading annotations in pickle format from %s' % filename)
 
-        handle = open (filename, 'r')
+        handle = open (filename, 'rb')
         pk = pickle.Unpickler (handle)
         annotList = pk.load()
         handle.close()
@@ -335,7 +455,7 @@ class AnnotationList (object):
 
     def toPickle (self, filename):
 
-        pickHandle = open (filename, 'w')
+        pickHandle = open (filename, 'wb')
         pk = pickle.Pickler (pickHandle, pickle.HIGHEST_PROTOCOL)
         pk.dump (self)
         pickHandle.close()
@@ -366,11 +486,13 @@ class AnnotationList (object):
 
             logger.debug('creating gene name lookup table')
 
-            self.geneDict = dict()
+            geneDict = defaultdict(list)
 
             for chr in self.chromosomes():
                 for gene in self.annot[chr].getChildren():
-                    self.geneDict.setdefault(gene.name, []).append(gene)
+                    geneDict[gene.name].append(gene)
+
+            self.geneDict = dict(geneDict)      # plain dict: lookups of unknown names must not insert
 
         return self.geneDict
 
@@ -389,107 +511,101 @@ class AnnotationList (object):
         '''
 
         # We will process every annotated exon. But many exons appear
-        # in multiple transcripts of a given gene. We will cache the
-        # polyA annotations we compute, and apply the cached value to
-        # any later occurrence of an exon with the same start/stop
-        # coordinates. This delivers about a 10-to-1 speedup.
+        # in multiple transcripts of a given gene, and sometimes in
+        # overlapping genes too. So we make two passes over each
+        # chromosome: the first collects the distinct (start, end,
+        # strand) regions, which are handed to the reference in one
+        # batch; the second applies the results to every exon. Strand
+        # is part of the key, since it determines whether we look for
+        # A's or T's. Deduplication delivers about a 10-to-1 speedup.
 
         for chr in self.chromosomes():                    # chr is a string
 
             logger.debug('adding polyA annotations for chr %s' % chr)
 
-            numExons  = 0
-            numCached = 0
-            numPoly   = 0
-
+            exons = list()
             for gene in self.geneList (chr):              # gene is an Annotation object
-
-                cache = dict()                            # we'll cache polyAs, one gene at a time
-
                 for tran in gene.getChildren():           # tran is an Annotation object
-                    for exon in tran.getChildren():       # exon is an Annotation object
+                    exons.extend (tran.getChildren())     # exon is an Annotation object
 
-                        numExons += 1
+            regions = set([(exon.start, exon.end, exon.strand) for exon in exons])
+            polyDict = ref.findPolyAsBatch (chr, regions)
 
-                        if hasattr (exon, 'polyAs'):
-                            delattr (exon, 'polyAs')      # pickled annotation might contain stale info
+            numPoly = 0
 
-                        key = '%09d-%09d' % (exon.start, exon.end)
-                        if key not in cache:
-                            cache[key] = ref.findPolyAs (chr, exon.start, exon.end, exon.strand)
-                        else:
-                            numCached += 1
-                        polys = cache[key]
+            for exon in exons:
 
-####                        if gene.name == 'KRAS':
-####                            print '%s %s %d %d %s' % (exon.name, chr, exon.start, exon.end, exon.strand)
-####                            print polys
+                try:
+                    del exon.polyAs                       # pickled annotation might contain stale info
+                except AttributeError:
+                    pass
 
-                        if len(polys) > 0:
-                            exon.polyAs = polys
-                            numPoly += 1
+                polys = polyDict[(exon.start, exon.end, exon.strand)]
+                if len(polys) > 0:
+                    exon.polyAs = polys
+                    numPoly += 1
 
-            logger.debug('%d of %d exons were cached' % (numCached, numExons))
+            logger.debug('%d of %d exons were cached' % (len(exons) - len(regions), len(exons)))
             logger.debug('%d polyA tracts were found' % (numPoly))
 
         return
 
 
-class AnnotationCursor (object):
+class AnnotationIndex (object):
     '''
-    Class supporting the walking of an AnnotationList.
+    Overlap queries against an AnnotationList, in any order.
     '''
 
+    # Each query is answered on its own, so queries may arrive in any
+    # order. It uses the sorted gene lists plus a running maximum of
+    # gene ends. The running maximum never decreases, so a binary
+    # search on it finds the first gene which could possibly reach
+    # the start of the query range -- every gene before that ends at
+    # or before the range start. A second binary search on the gene
+    # starts finds the last gene which begins within the range. Only
+    # the genes in between need to be looked at.
+
     def __init__ (self, annotList):
 
         self.annotList = annotList
-        self.posit = dict( [ (chr, 0) for chr in annotList.chromosomes() ] )
+        self.coords = dict()         # key=chr value=gene starts, ends, strands and max ends (created and cached when needed)
 
-    def advance (self, chr, start):
+    def geneCoords (self, chr):
         '''
-        Move the cursor past genes which end prior to the specified
-        start position on specified chr.
+        Return parallel lists of start, end, strand and running
+        maximum end for the genes on the specified chr.
         '''
 
-        geneList = self.annotList.geneList (chr)
-        numGenes = geneList.numChildren()
-        curPos = self.posit[chr]
-        while curPos < numGenes and geneList[curPos].end < start:
-            curPos += 1
-        self.posit[chr] = curPos
+        if chr not in self.coords:
 
-    def getOverlappingGenes (self, chr, start, end, strand):
-        '''
-        Generator function returns genes from the specified strand,
-        starting from current cursor position, up to point where gene
-        starts after end position of specified range. Does NOT change
-        the current cursor position, since the next query may want
-        some of the same genes. (To move the cursor, call advance.)
-        '''
+            genes = self.annotList.geneList(chr).children or []
 
-        # Here we need to deal with the case where gene A completely overlaps gene B:
+            maxEnds = list()
+            maxEnd  = 0
+            for gene in genes:
+                maxEnd = max(maxEnd, gene.end)
+                maxEnds.append(maxEnd)
 
-        #         10000                                   20000
-        #  gene A |-------------------------------------------|
-        #  gene B      |----------------|
-        #  read 1                           |-----------|
-        #  read 2                                                  |-----------|
+            self.coords[chr] = ( [gene.start  for gene in genes],
+                                 [gene.end    for gene in genes],
+                                 [gene.strand for gene in genes],
+                                 maxEnds )
 
-        # $pos will stick at 10000 until read 2 is encountered. But we
-        # don't want to report gene B for read 1.
+        return self.coords[chr]
 
+    def getOverlappingGenes (self, chr, start, end, strand):
+        '''
+        Generator function returns genes from the specified strand
+        which overlap the specified range, in gene start order.
+        '''
 
         geneList = self.annotList.geneList (chr)
-        numGenes = geneList.numChildren()
-        curPos = self.posit[chr]
-
-        while curPos < numGenes and geneList[curPos].start <= end:
-            
-            curGene = geneList[curPos]
-
-            if curGene.strand == strand and curGene.end > start:
-                yield curGene
+        starts, ends, strands, maxEnds = self.geneCoords (chr)
+        firstPos = bisect.bisect_right (maxEnds, start)            # first gene which might end after start of range
+        stopAt   = bisect.bisect_right (starts, end, firstPos)     # first gene which starts after end of range
 
-            curPos += 1
+        for ix in xrange(firstPos, stopAt):
+            if strands[ix] == strand and ends[ix] > start:
+                yield geneList[ix]
 
         return
@@ -11,14 +11,12 @@ import re                       # for regular expressions
 import math
 from tt_log import logger
 
-VERSION = '20150707.01'
+VERSION = '20261015.01'
 logger.debug('version %s loaded' % VERSION)
 
 DEF_Q = 50.0                    # Q score for error-free exon
 
 regexFields   = re.compile('(\d+)([MNDISH])')
-regexLeading  = re.compile('^(\d+)S')
-regexTrailing = re.compile('(\d+)S$')
 regexDigits   = re.compile('(\d+)')
 regexBases    = re.compile('([ACGTNacgtn]+)')
 regexMismatch = re.compile('([0ACGTNacgtn]+)')
@@ -68,13 +66,25 @@ class CigarString (object):
         self.string  = string
         self.start   = start     # genomic start coordinate
 
-        match = re.search(regexLeading, self.string)
-        self.leading = int(match.group(1)) if match is not None else 0
-        match = re.search(regexTrailing, self.string)
-        self.trailing = int(match.group(1)) if match is not None else 0
-
         self.MD      = MD        # MD field from SAM file: may not be present
-        self.cfields = re.findall(regexFields, string)
+        self.cfields = regexFields.findall(string)
+
+        # Soft clips can only be the first or last field. We have the
+        # fields already, so there's no need to search the string again
+        # for them. The startswith/endswith checks keep this exactly
+        # equivalent to matching '^(\d+)S' and '(\d+)S$', even if the
+        # string has ops regexFields doesn't know about.
+
+        self.leading  = 0
+        self.trailing = 0
+        if len(self.cfields) > 0:
+            count, op = self.cfields[0]
+            if op == 'S' and string.startswith(count + op):
+                self.leading = int(count)
+            count, op = self.cfields[-1]
+            if op == 'S' and string.endswith(count + op):
+                self.trailing = int(count)
+
         if MD is not None:
             self.expandCigarString()           # add substitution errors to cigar string
         else:
@@ -5,17 +5,22 @@
 import os
 import sys
 import re                       # for regular expressions
+from collections import defaultdict
 import cPickle as pickle
 
 from tt_log import logger
+import Annotations as anno
 
-VERSION = '20150814.01'
+VERSION = '20261015.01'
 logger.debug('version %s loaded' % VERSION)
 
 regexFP = re.compile('f(\d+)p(\d+)')      # finds full and partial read counts in cluster ID
 
 class Cluster (object):
 
+    __slots__ = ('name', 'flags', 'chr', 'start', 'strand', 'cigar', 'bases',
+                 'pctGC', 'bestGene', 'bestTran', 'bestScore')
+
     def __init__ (self, name, flags, chr, start, strand, cigar, bases):
 
         self.name   = name
@@ -30,6 +35,10 @@ class Cluster (object):
         self.bestTran  = None
         self.bestScore = None
 
+    def __setstate__ (self, state):
+        '''Support unpickling, including pickles made before Cluster had __slots__.'''
+        anno.setSlotState (self, state)
+
     def best (self, bestGene, bestTran, bestScore):
         '''Add match findings.'''
         
@@ -42,7 +51,7 @@ class Cluster (object):
     def getFP (self):
         '''Return counts of full and partial reads making up the cluster.'''
 
-        match = re.search (regexFP, self.name)
+        match = regexFP.search (self.name)
         if match is None:
 ####            raise RuntimeError ('full/partial counts not found in cluster name %s' % self.name)
             return 0, 0
@@ -57,16 +66,27 @@ class Cluster (object):
         # starting at x. When plotting, you may want to adjust the
         # coordinates to center the window on x.
 
+        # Counting G+C in every window is O(N*window). Instead, count
+        # the first window, then slide it along one base at a time,
+        # dropping the base that falls off the left and adding the one
+        # that comes in on the right.
+
         if self.pctGC is None:
 
+            bases = self.bases
             self.pctGC = list()
 
-            for ix in xrange(len(self.bases)-window):
+            gc = bases.count ('G', 0, window) + bases.count ('C', 0, window)
+
+            for ix in xrange(len(bases)-window):
 
-                gc = self.bases.count ('G', ix, ix+window) \
-                   + self.bases.count ('C', ix, ix+window)
                 self.pctGC.append (float(gc) / float(window) * 100.0)
 
+                if bases[ix] == 'G' or bases[ix] == 'C':
+                    gc -= 1
+                if bases[ix+window] == 'G' or bases[ix+window] == 'C':
+                    gc += 1
+
         return self.pctGC
         
 class ClusterDict (object):
@@ -80,7 +100,7 @@ class ClusterDict (object):
     def fromPickle (filename):
         '''Create a ClusterDict object from a pickle file (alternative to __init__).'''
 
-        handle = open (filename, 'r')
+        handle = open (filename, 'rb')
         pk = pickle.Unpickler (handle)
         clusterDict = pk.load()
         handle.close()
@@ -103,10 +123,11 @@ class ClusterDict (object):
         '''Create and cache mapping from gene name to clusters which match it.'''
 
         if self.geneDict is None:
-            self.geneDict = dict()
+            geneDict = defaultdict(list)
             for cluster in self.clusterDict.values():
                 if cluster.bestGene is not None:
-                    self.geneDict.setdefault(cluster.bestGene.name, []).append(cluster)
+                    geneDict[cluster.bestGene.name].append(cluster)
+            self.geneDict = dict(geneDict)
     
         return self.geneDict
 
@@ -135,7 +156,7 @@ class ClusterDict (object):
 
         self.geneDict =  None         # no need to pickle this, it can be recreated
 
-        pickHandle = open (filename, 'w')
+        pickHandle = open (filename, 'wb')
         pk = pickle.Pickler (pickHandle, pickle.HIGHEST_PROTOCOL)
         pk.dump (self)
         pickHandle.close()
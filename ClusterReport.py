@@ -4,10 +4,9 @@
 
 import os
 import sys
-import re                       # for regular expressions
 from tt_log import logger
 
-VERSION = '20141029.01'
+VERSION = '20261015.01'
 logger.debug('version %s loaded' % VERSION)
 
 class ClusterList (object):
@@ -21,11 +20,8 @@ class ClusterList (object):
         self.filename = filename
         self.clusters = dict()       # this is the stuff
         self.cells    = dict()       # key=cell long name  value=cell number
-        self.numCells = 0
         self.numClusters = 0
 
-        regexCCS = re.compile ('_CCS$')
-
         handle = open (filename, 'r')
         header = handle.readline().strip()            # get header line
 
@@ -41,20 +37,18 @@ class ClusterList (object):
                 clusterID, readName, FL = line.strip().split()
 
             cell, ZMW, coords = readName.split('/')
-            coords = re.sub (regexCCS, '', coords)          # get rid of '_CCS' at end of read range
+            if coords.endswith('_CCS'):                     # get rid of '_CCS' at end of read range
+                coords = coords[:-4]
             shortName = ZMW + '|' + coords
 
-            if cell not in self.cells:                      # have we seen this cell before?
-                self.numCells += 1
-                self.cells[cell] = self.numCells            # if not, give it a number
-            cellNo = self.cells[cell]
+            cellNo = self.cells.setdefault(intern(cell), len(self.cells)+1)     # number new cells as we see them
             
             clusterEnt = self.clusters.setdefault(clusterID, {}).setdefault(FL, {}).setdefault(cellNo, [])
             clusterEnt.append (shortName)
 
         handle.close()
 
-        logger.debug('read %d reads in %d clusters from %d cells' % (self.numClusters, len(self.clusters), self.numCells))
+        logger.debug('read %d reads in %d clusters from %d cells' % (self.numClusters, len(self.clusters), len(self.cells)))
 
     def showReads (self, clusterID):
         '''Generator function returns all reads for a specified cluster.'''
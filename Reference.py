@@ -10,7 +10,7 @@ import cPickle as pickle
 
 from tt_log import logger
 
-VERSION = '20150623.01'
+VERSION = '20261015.01'
 logger.debug('version %s loaded' % VERSION)
 
 DEF_WINDOW = 23
@@ -48,7 +48,7 @@ class Reference (object):
                     self.ref[chr] = ''.join(accum)     # see comment block above
                     accum = list()
 
-                chr = re.match(regexChr, line).group(1)
+                chr = regexChr.match(line).group(1)
                 if chr in self.ref:
                     raise RuntimeError ('duplicate chromsome %s' % chr)
                 self.chrList.append(chr)
@@ -67,7 +67,7 @@ class Reference (object):
 
         logger.debug('reading reference in pickle format from %s' % filename)
 
-        handle = open (filename, 'r')
+        handle = open (filename, 'rb')
         pk = pickle.Unpickler (handle)
         ref = pk.load()
         handle.close()
@@ -76,7 +76,7 @@ class Reference (object):
 
     def toPickle (self, filename):
 
-        pickHandle = open (filename, 'w')
+        pickHandle = open (filename, 'wb')
         pk = pickle.Pickler (pickHandle, pickle.HIGHEST_PROTOCOL)
         pk.dump (self)
         pickHandle.close()
@@ -124,54 +124,92 @@ class Reference (object):
         # exclusive of the last element. I.e., [0:100] describes those
         # same first 100 bases.
 
-        polyAs = list()
-        if end-start+1 < window:
-            return polyAs
-        
-        look4 = 'A' if strand ==  '+' else 'T'
-        winStart = start - 1                                              # 0-based index of first base of currently accepted tract
-        winEnd   = winStart + window - 1                                  # 0-based index of last base of currently accepted tract
-        stopAt   = min(end-1, len(self.ref[chr])-1)                       # 0-based index of last usable base
-####        print 'stopAt: %2d  end: %2d' % (stopAt, winEnd)
+        if end-start+1 < window:                  # before touching self.ref: chr may not be in it
+            return list()
 
-        while winEnd <= stopAt:
+        return scanPolyAs (self.ref[chr], start, end, strand, window, thresh)
 
-            howmany = self.ref[chr].count(look4, winStart, winEnd+1)
-            numNeeded = int(math.ceil( (winEnd-winStart+1) * thresh))     # rounds upward
+    def findPolyAsBatch (self, chr, regions, window=DEF_WINDOW, thresh=DEF_THRESH):
+        '''
+        Find A/T-rich regions for many ranges on one chromosome.
+        Regions is an iterable of (start, end, strand) tuples. Returns a
+        dict: key=(start, end, strand) value=list of polyAs, as from
+        findPolyAs.
+        '''
 
-####            print '---> start: %2d  end: %2d  needed: %2d  howmany: %2d' % (winStart, winEnd, numNeeded, howmany)
+        # Look up the chromosome once, and visit the regions in
+        # coordinate order, so we walk forward through the sequence
+        # rather than jumping around in it. As in findPolyAs, regions
+        # shorter than the window don't need the sequence at all, so
+        # it is not looked up until some region does: a chromosome
+        # with no such regions need not be in the reference.
 
-            if howmany < numNeeded:
+        seq = None
 
-                # Bump by the smallest number of bases that could get
-                # us to the total required. E.g.: suppose window=20,
-                # thresh=.9, numNeeded=18. If we have 15 bases in the
-                # window (howmany=15), we need to bump by at least 3
-                # to get to 18.
+        polyDict = dict()
+        for region in sorted(set(regions)):
+            start, end, strand = region
+            if end-start+1 < window:
+                polyDict[region] = list()
+                continue
+            if seq is None:
+                seq = self.ref[chr]
+            polyDict[region] = scanPolyAs (seq, start, end, strand, window, thresh)
 
-                winStart += numNeeded - howmany
+        return polyDict
 
-            else:    # we've found a tract, now extend it
 
-                while winEnd < stopAt:
+def scanPolyAs (seq, start, end, strand, window=DEF_WINDOW, thresh=DEF_THRESH):
+    '''Find all A/T-rich regions in a range of a sequence string. See Reference.findPolyAs.'''
 
-                    winEnd += 1                                                   # bump window size
+    polyAs = list()
+    if end-start+1 < window:
+        return polyAs
 
-                    numNeeded = int(math.ceil( (winEnd-winStart+1) * thresh))     # new numNeeded for larger window
-                    if self.ref[chr][winEnd] == look4:
-                        howmany += 1                                              # new number of As for larger window
-####                    print '     start: %2d  end: %2d  needed: %2d  howmany: %2d' % (winStart, winEnd, numNeeded, howmany)
+    look4 = 'A' if strand ==  '+' else 'T'
+    winStart = start - 1                                              # 0-based index of first base of currently accepted tract
+    winEnd   = winStart + window - 1                                  # 0-based index of last base of currently accepted tract
+    stopAt   = min(end-1, len(seq)-1)                                 # 0-based index of last usable base
+####    print 'stopAt: %2d  end: %2d' % (stopAt, winEnd)
 
-                    if howmany < numNeeded:                                       # does larger window still work?
-                        winEnd -= 1                                               # reject larger window
-                        break
+    while winEnd <= stopAt:
 
-                polyAs.append( [winStart+1, winEnd+1, howmany] )                  # returned indexes are 1-based
-                winStart = winEnd
+        howmany = seq.count(look4, winStart, winEnd+1)
+        numNeeded = int(math.ceil( (winEnd-winStart+1) * thresh))     # rounds upward
 
-            winEnd = winStart + window - 1
+####        print '---> start: %2d  end: %2d  needed: %2d  howmany: %2d' % (winStart, winEnd, numNeeded, howmany)
 
-        return polyAs
+        if howmany < numNeeded:
+
+            # Bump by the smallest number of bases that could get
+            # us to the total required. E.g.: suppose window=20,
+            # thresh=.9, numNeeded=18. If we have 15 bases in the
+            # window (howmany=15), we need to bump by at least 3
+            # to get to 18.
+
+            winStart += numNeeded - howmany
+
+        else:    # we've found a tract, now extend it
+
+            while winEnd < stopAt:
+
+                winEnd += 1                                                   # bump window size
+
+                numNeeded = int(math.ceil( (winEnd-winStart+1) * thresh))     # new numNeeded for larger window
+                if seq[winEnd] == look4:
+                    howmany += 1                                              # new number of As for larger window
+####                print '     start: %2d  end: %2d  needed: %2d  howmany: %2d' % (winStart, winEnd, numNeeded, howmany)
+
+                if howmany < numNeeded:                                       # does larger window still work?
+                    winEnd -= 1                                               # reject larger window
+                    break
+
+            polyAs.append( [winStart+1, winEnd+1, howmany] )                  # returned indexes are 1-based
+            winStart = winEnd
+
+        winEnd = winStart + window - 1
+
+    return polyAs
 
 
 class PhonyRef (Reference):
@@ -211,6 +249,24 @@ def unitTest ():
             print 'test %d failed:' % (ix+1)
             print result
 
+    # A chromosome missing from the reference is fine, as long as no
+    # region on it is long enough to need the sequence.
+
+    ix = len(testcases)
+    phony = PhonyRef(chr, testcases[0][0])
+    try:
+        result = [ phony.findPolyAsBatch ('chrUn', []),
+                   phony.findPolyAsBatch ('chrUn', [(1, 10, '+'), (5, 9, '-')]),
+                   phony.findPolyAs ('chrUn', 1, 10, '+') ]
+    except KeyError as ex:
+        result = 'KeyError: %s' % ex
+
+    if result == [ {}, {(1, 10, '+') : [], (5, 9, '-') : []}, [] ]:
+        print 'test %d passed' % (ix+1)
+    else:
+        print 'test %d failed:' % (ix+1)
+        print result
+
 if __name__ == "__main__":
     unitTest()
 
@@ -4,8 +4,8 @@
 # human genomic reference. Read the GENCODE .gtf annotations file. For
 # each isoform, print the genes, transcripts and exons it overlaps.
 
-# Both the SAM and annotation files are assumed to be sorted by chr
-# and position.
+# The annotation file is assumed to be sorted by chr and position.
+# The SAM file need not be.
 
 # AUTHOR: Tom Skelly (thomas.skelly@fnlcr.nih.gov)
 
@@ -13,7 +13,10 @@ import os
 import sys
 import optparse
 import re        # regular expressions
+import bisect
 import cPickle as pickle
+import cStringIO
+import multiprocessing
 
 from tt_log import logger
 import Annotations   as anno
@@ -23,7 +26,7 @@ import ClusterReport as clrep
 import CigarString   as cs
 import PolyA
 
-VERSION = '20150611.02'
+VERSION = '20261015.01'
 
 FLAG_NOT_ALIGNED = 0x04         # SAM file flags
 FLAG_REVERSE     = 0x10
@@ -31,13 +34,28 @@ FLAG_SECONDARY   = 0x100
 
 POLYA_REACH = 30                # how far from 3' end to look for poly-A motif
 CL_PER_LINE = 6                 # number of cluster IDs per cl: line
+BATCH_SIZE  = 500               # SAM lines per batch handed to a --procs worker
 
-def main ():
+workerArgs = None               # matchIsoform's fixed arguments, in a --procs worker process: see initWorker
+
+# SAM tag patterns. These are searched separately rather than as one
+# alternation: each starts with a literal, which the regex engine
+# finds very quickly, while an alternation forces it to try every
+# branch at every position of the line (~25x slower on aligned reads).
+
+regexAS = re.compile('(AS:i:\d+)')        # alignment score
+regexUT = re.compile('(uT:A:\d+)')        # mismatch reason (ToDo: Translate this)
+regexMD = re.compile('MD:Z:(\S+)')        # MD string
+
+regexClusterID = re.compile('(c\d+)')     # isoform name format varies, but cnnnn should be in there somewhere
+
+def main (argv=None):
 
     logger.debug('version %s starting' % VERSION)
 
-    opt, args = getParms()
+    opt, args = getParms(argv)
 
+    clusterList = None
     if opt.clusters is not None:
         clusterList = clrep.ClusterList (opt.clusters)     # read the cluster_report.csv file, if supplied
 
@@ -48,14 +66,10 @@ def main ():
     else:     # standard format
         annotList = anno.AnnotationList (opt.gtf)
 
-    annotCursor = anno.AnnotationCursor (annotList)
+    annotIndex = anno.AnnotationIndex (annotList)
 
     polyAFinder = PolyA.PolyA()
 
-    regexAS = re.compile('(AS:i:\d+)')       # alignment score
-    regexUT = re.compile('(uT:A:\d+)')       # mismatch reason (ToDo: Translate this)
-    regexMD = re.compile('MD:Z:(\S+)')       # MD string
-
     if len(args) > 0:
         logger.debug('reading SAM file %s' % args[0])
         handle = open (args[0], 'r')
@@ -63,171 +77,254 @@ def main ():
         logger.debug('reading SAM data from stdin')
         handle = sys.stdin
 
-    totReads = 0                  # assorted counters
-    totAlign = 0
-    totWithGene = 0
-    totMulti = 0
-    totReverse = 0
-    totByScore = [0,0,0,0,0,0]    # indexed by score
-    totSplice  = [0,0,0,0,0,0]
+    totals = Totals()                       # assorted counters
 
     clusterDict = cl.ClusterDict()          # annotation matches saved for later pickling
-    lastPos = dict()              # current position in SAM file by chr (for sort check)
 
-    for line in handle:           # main loop: read the SAM file
+    # Each isoform is matched independently of the others, so with
+    # --procs we can hand batches of SAM lines to worker processes.
+    # The workers are forked after the annotations are loaded, so
+    # they share them rather than receiving copies. Each batch comes
+    # back as printed text plus counters, and imap returns batches in
+    # input order, so the output is the same as a serial run. Cluster
+    # objects refer into the annotations and can't be shipped back
+    # cheaply, so --outpickle runs serially.
 
-        if line.startswith('@'):
-            continue
+    if opt.procs > 1 and opt.outpickle is None:
 
-        totReads += 1
+        logger.debug('matching isoforms with %d processes' % opt.procs)
 
-        lineFields = line.split('\t')                          # just split it once, not 6 times in list comp
-        if len(lineFields) < 10:
-            raise RuntimeError ('mis-formed SAM line: %s' % line)
-        clusterName, flags, chr, start, cigarString, bases = [lineFields[i] for i in (0,1,2,3,5,9)]
-        flags = int(flags)
+        pool = multiprocessing.Pool (opt.procs, initWorker, (opt, annotIndex, polyAFinder, clusterList))
+        for text, batchTotals in pool.imap (matchBatch, readBatches (handle, BATCH_SIZE)):
+            sys.stdout.write (text)
+            totals.add (batchTotals)
+        pool.close()
+        pool.join()
 
-        if flags & FLAG_NOT_ALIGNED:
+    else:
 
-            print '\nisoform:  %-16s' % (clusterName)
+        for line in handle:           # main loop: read the SAM file
+            matchIsoform (line, opt, annotIndex, polyAFinder, clusterList, clusterDict, totals)
 
-            if opt.clusters is not None:                       # print cluster (cl:) lines
-                printClusterReads (clusterList, clusterName)
+    if opt.outpickle is not None:
+        clusterDict.toPickle (opt.outpickle)                             # save matches as pickle file
 
-            print 'result:   %-50s no_alignment_found' % clusterName,    # no EOL yet
+    print  '\nsummary: version %s\n' % VERSION
 
-            alnReason = re.search(regexUT, line)      # mismatch reason
-            if alnReason is not None:
-                print ' %s' % alnReason.group(1),
-            alnScore  = re.search(regexAS, line)      # alignment score
-            if alnScore is not None:
-                print ' %s' % alnScore.group(1),
-            print
+    if opt.clusters is not None:
+        for cellNo, cell in clusterList.showCells():
+            print 'summary:   cell %d = %s' % (cellNo, cell)
+        print
 
-            continue
+    print 'summary: %7d isoforms read' % totals.reads
+    print 'summary: %7d isoforms aligned, of which %d were multiply mapped' % (totals.align, totals.multi)
+    print 'summary: %7d isoforms hit at least one gene, of which %d were on opposite strand' % (totals.withGene, totals.reverse)
+    print
 
-        totAlign += 1
+    for score in xrange(5,-1,-1):
+        print 'summary: %7d isoforms scored %d, of which %6d had splice termination motif' \
+            % (totals.byScore[score], score, totals.splice[score])
 
-        start = int(start)
-        if start < lastPos.get(chr, 0):
-            raise RuntimeError ('SAM file is not sorted by position')
-        lastPos[chr] = start
+    logger.debug('finished')
 
-        match = re.search(regexMD, line)
-        if match is not None:                         # if  MD string is present
-            cigar = cs.CigarString(cigarString, start, match.group(1))
-        else:
-            cigar = cs.CigarString(cigarString, start)
+def matchIsoform (line, opt, annotIndex, polyAFinder, clusterList, clusterDict, totals):
+    '''Match one SAM line against the annotations, print the results, and count them in totals.'''
 
-        end   = start + cigar.genomicLength() - 1;    # -1 to report last base, rather than last+1
+    if line.startswith('@'):
+        return
 
-        exons = cigar.exons()
+    totals.reads += 1
 
-        strand = '-' if (flags & FLAG_REVERSE) else '+'
+    # Split off the 11 mandatory fields, and leave the optional
+    # tags in one piece. We never need the tags individually,
+    # and searching them on their own keeps the tag regexes from
+    # scanning the sequence and quality strings.
 
-        if opt.outpickle is not None:
-            myCluster = cl.Cluster(clusterName, flags, chr, start, strand, cigar, bases)    # cigar is a CigarString object
-            clusterDict.addCluster (myCluster)
-
-        print '\nisoform:  %-16s    %9d                    %9d         %-5s  %s  %6d' \
-            % (clusterName, start, end, chr, strand, end-start),
-        if flags & FLAG_SECONDARY:
-            print ' multimap',
-            totMulti += 1
-        print
+    lineFields = line.split('\t', 11)                      # just split it once, not 6 times in list comp
+    if len(lineFields) < 10:
+        raise RuntimeError ('mis-formed SAM line: %s' % line)
+    clusterName, flags, chr, start, cigarString, bases = [lineFields[i] for i in (0,1,2,3,5,9)]
+    flags = int(flags)
+    tags  = lineFields[11] if len(lineFields) > 11 else ''
 
-        print 'cigar:    %s' % cigar.prettyPrint()
-        if cigar.MD is not None:
-            print 'MD:       %s' % cigar.MD
+    if flags & FLAG_NOT_ALIGNED:
 
-        if opt.vars is not None:                         # print variant (var:) lines
-            cigar.printVariantList(bases)
+        print '\nisoform:  %-16s' % (clusterName)
 
-        if opt.clusters is not None:                     # print cluster (cl:) lines
+        if opt.clusters is not None:                       # print cluster (cl:) lines
             printClusterReads (clusterList, clusterName)
 
-        foundPolyA = False
-        print 'polyA:  ',                                # print 'polyA:' line
-        for motif, offset in polyAFinder.findMotifs (bases, strand, POLYA_REACH):
-            print ' %s: %4d' % (motif, offset),
-            foundPolyA = True
+        print 'result:   %-50s no_alignment_found' % clusterName,    # no EOL yet
+
+        alnReason = regexUT.search(tags)      # mismatch reason
+        if alnReason is not None:
+            print ' %s' % alnReason.group(1),
+        alnScore  = regexAS.search(tags)      # alignment score
+        if alnScore is not None:
+            print ' %s' % alnScore.group(1),
         print
 
-        # Now let's do the genes...
+        return
 
-        # Bump cursor past any genes which end prior to the start of
-        # the current read. We're done looking at them.
+    totals.align += 1
 
-        annotCursor.advance (chr, start)
+    start = int(start)
 
-        bestHit = best.Best()
+    match = regexMD.search(tags)
+    if match is not None:                         # if  MD string is present
+        cigar = cs.CigarString(cigarString, start, match.group(1))
+    else:
+        cigar = cs.CigarString(cigarString, start)
 
-        # Loop through genes this cluster overlaps. Try the aligned
-        # strand first, but if no joy, try the other strand, since
-        # IsoSeq can get it backwards sometimes.
+    end   = start + cigar.genomicLength() - 1;    # -1 to report last base, rather than last+1
 
-        for str2try in (strand, '-' if strand == '+' else '+'):        # try aligned strand first
+    exons = cigar.exons()
 
-            for curGene in annotCursor.getOverlappingGenes (chr, start, end, str2try):
+    strand = '-' if (flags & FLAG_REVERSE) else '+'
 
-                print 'gene:     %-16s    %9d            %6d             %9d  %5d     %s' \
-                    % (curGene.name, curGene.start, curGene.start-start, curGene.end, curGene.end-end, curGene.strand),
-                if str2try != strand:
-                    print '  rev',
-                print
+    if opt.outpickle is not None:
+        myCluster = cl.Cluster(clusterName, flags, chr, start, strand, cigar, bases)    # cigar is a CigarString object
+        clusterDict.addCluster (myCluster)
+
+    print '\nisoform:  %-16s    %9d                    %9d         %-5s  %s  %6d' \
+        % (clusterName, start, end, chr, strand, end-start),
+    if flags & FLAG_SECONDARY:
+        print ' multimap',
+        totals.multi += 1
+    print
 
-                bestTran, bestScore = matchTranscripts (exons, curGene)     # match this cluster to all transcripts of gene
-                bestHit.update (bestScore, [curGene, bestTran])             # best transcript of best gene so far?
+    print 'cigar:    %s' % cigar.prettyPrint()
+    if cigar.MD is not None:
+        print 'MD:       %s' % cigar.MD
 
-            if bestHit.which > 1:                                           # if decent match found, don't try the other strand
-                break
+    if opt.vars is not None:                         # print variant (var:) lines
+        cigar.printVariantList(bases)
 
-        if bestHit.value is None:
-            print 'result:   %-50s no_genes_found' % (clusterName)
-        else:
+    if opt.clusters is not None:                     # print cluster (cl:) lines
+        printClusterReads (clusterList, clusterName)
+
+    foundPolyA = False
+    print 'polyA:  ',                                # print 'polyA:' line
+    for motif, offset in polyAFinder.findMotifs (bases, strand, POLYA_REACH):
+        print ' %s: %4d' % (motif, offset),
+        foundPolyA = True
+    print
+
+    # Now let's do the genes...
+
+    bestHit = best.Best()
 
-            bestGene, bestTran = bestHit.which
-            print 'result:   %-50s  %-20s  %-24s  ex: %2d  sc: %d' \
-                % (clusterName, bestGene.name, bestTran.name, len(exons), bestHit.value),
+    # Loop through genes this cluster overlaps. Try the aligned
+    # strand first, but if no joy, try the other strand, since
+    # IsoSeq can get it backwards sometimes.
 
-            if bestGene.strand != strand:                                # if best hit was on other strand from alignment
-                print 'rev',
-                totReverse += 1
+    for str2try in (strand, '-' if strand == '+' else '+'):        # try aligned strand first
 
-            if bestHit.value >= 3:
-                delta5 = bestTran[0].start - exons[0].start              # 5' delta
-                delta3 = bestTran[-1].end  - exons[-1].end               # 3' delta
-                print ' 5-3: %5d %5d' % (delta5, delta3),
+        for curGene in annotIndex.getOverlappingGenes (chr, start, end, str2try):
+
+            print 'gene:     %-16s    %9d            %6d             %9d  %5d     %s' \
+                % (curGene.name, curGene.start, curGene.start-start, curGene.end, curGene.end-end, curGene.strand),
+            if str2try != strand:
+                print '  rev',
             print
 
-            totWithGene += 1
-            totByScore[bestHit.value] += 1
-            if foundPolyA:
-                totSplice[bestHit.value] += 1
+            bestTran, bestScore = matchTranscripts (exons, curGene)     # match this cluster to all transcripts of gene
+            bestHit.update (bestScore, [curGene, bestTran])             # best transcript of best gene so far?
 
-            if opt.outpickle is not None:
-                myCluster.best(bestGene, bestTran, bestScore)            # keep track of best gene in pickle object
+        if bestHit.which > 1:                                           # if decent match found, don't try the other strand
+            break
 
-    if opt.outpickle is not None:
-        clusterDict.toPickle (opt.outpickle)                             # save matches as pickle file
+    if bestHit.value is None:
+        print 'result:   %-50s no_genes_found' % (clusterName)
+    else:
 
-    print  '\nsummary: version %s\n' % VERSION
+        bestGene, bestTran = bestHit.which
+        print 'result:   %-50s  %-20s  %-24s  ex: %2d  sc: %d' \
+            % (clusterName, bestGene.name, bestTran.name, len(exons), bestHit.value),
 
-    if opt.clusters is not None:
-        for cellNo, cell in clusterList.showCells():
-            print 'summary:   cell %d = %s' % (cellNo, cell)
+        if bestGene.strand != strand:                                # if best hit was on other strand from alignment
+            print 'rev',
+            totals.reverse += 1
+
+        if bestHit.value >= 3:
+            delta5 = bestTran[0].start - exons[0].start              # 5' delta
+            delta3 = bestTran[-1].end  - exons[-1].end               # 3' delta
+            print ' 5-3: %5d %5d' % (delta5, delta3),
         print
 
-    print 'summary: %7d isoforms read' % totReads
-    print 'summary: %7d isoforms aligned, of which %d were multiply mapped' % (totAlign, totMulti)
-    print 'summary: %7d isoforms hit at least one gene, of which %d were on opposite strand' % (totWithGene, totReverse)
-    print
+        totals.withGene += 1
+        totals.byScore[bestHit.value] += 1
+        if foundPolyA:
+            totals.splice[bestHit.value] += 1
 
-    for score in xrange(5,-1,-1):
-        print 'summary: %7d isoforms scored %d, of which %6d had splice termination motif' \
-            % (totByScore[score], score, totSplice[score])
+        if opt.outpickle is not None:
+            myCluster.best(bestGene, bestTran, bestScore)            # keep track of best gene in pickle object
 
-    logger.debug('finished')
+class Totals (object):
+    '''Counters for the summary report.'''
+
+    def __init__ (self):
+
+        self.reads    = 0
+        self.align    = 0
+        self.withGene = 0
+        self.multi    = 0
+        self.reverse  = 0
+        self.byScore  = [0,0,0,0,0,0]    # indexed by score
+        self.splice   = [0,0,0,0,0,0]
+
+    def add (self, other):
+        '''Add another set of counters into this one.'''
+
+        self.reads    += other.reads
+        self.align    += other.align
+        self.withGene += other.withGene
+        self.multi    += other.multi
+        self.reverse  += other.reverse
+        for score in xrange(len(self.byScore)):
+            self.byScore[score] += other.byScore[score]
+            self.splice[score]  += other.splice[score]
+
+def readBatches (handle, batchSize):
+    '''Generator function returns lists of up to batchSize lines from handle.'''
+
+    batch = list()
+    for line in handle:
+        batch.append(line)
+        if len(batch) == batchSize:
+            yield batch
+            batch = list()
+
+    if len(batch) > 0:
+        yield batch
+
+    return
+
+def initWorker (*args):
+    '''Save matchIsoform's fixed arguments in a --procs worker process.'''
+
+    global workerArgs
+    workerArgs = args
+
+def matchBatch (lines):
+    '''
+    Run matchIsoform on a batch of lines in a --procs worker
+    process. Return the printed output as a string, and the counters.
+    '''
+
+    opt, annotIndex, polyAFinder, clusterList = workerArgs
+    totals = Totals()
+
+    saveStdout = sys.stdout
+    sys.stdout = cStringIO.StringIO()          # capture everything matchIsoform and friends print
+    try:
+        for line in lines:
+            matchIsoform (line, opt, annotIndex, polyAFinder, clusterList, None, totals)
+        text = sys.stdout.getvalue()
+    finally:
+        sys.stdout = saveStdout
+
+    return text, totals
 
 def matchTranscripts (readExons, gene):
     '''
@@ -240,18 +337,24 @@ def matchTranscripts (readExons, gene):
     print them.
     '''
 
-    strings = list()         # overlaps are computed in the first pass. save them (as strings) to print in pass 2.
+    overlaps = list()        # overlaps are computed in the first pass. save them to print in pass 2.
+    strings  = list()        # ... and also as strings
     scores  = list()         # scores saved for the print step
 
     bestScore = best.Best()
     bestTrunc = best.Best(reverse=True)
     bestHits  = best.Best()
 
+    readStarts, readEnds = exonCoords (readExons)                    # read coordinates don't change from one transcript to the next
+
     for ix, tran in enumerate (gene):
 
         tranExons = tran.children                                     # the list of exons for this transcript
 
-        overR, overT = findOverlaps (readExons, tranExons)
+        tranStarts, tranEnds = tran.childCoords()                     # cached in the transcript after the first time
+
+        overR, overT = findOverlapCoords (readStarts, readEnds, tranStarts, tranEnds)
+        overlaps.append((overR, overT))                               # save them for showCoords
         strings.append(overlap2string(overR))                         # save it for the print step as a string
 
         score = 0                                                     # default score
@@ -263,7 +366,7 @@ def matchTranscripts (readExons, gene):
             score = 1
             if isMatch (overR, overT):
                 score = 3
-                if internalMatch (readExons, tranExons):              # do their sizes match?
+                if internalMatch (readStarts, readEnds, tranStarts, tranEnds):    # do their sizes match?
                     score = 4                                         # may get promoted later
                     trunc = abs(readExons[0].start - tranExons[0].start) \
                         +   abs(readExons[-1].end  - tranExons[-1].end)   # leading and trailing exon truncation amount
@@ -287,7 +390,8 @@ def matchTranscripts (readExons, gene):
             % (tran.name, scores[ix], tran.numChildren(), tran.length, tran.ID, strings[ix])
 
         if scores[ix] >= 2:
-            showCoords (readExons, tran)
+            overR, overT = overlaps[ix]
+            showCoords (readExons, tran, overR, overT)
 
     # If we found no suitable transcript, we never call showCoords. At
     # least print the exons once.
@@ -299,11 +403,14 @@ def matchTranscripts (readExons, gene):
 
     return gene[bestScore.which], scores[bestScore.which]     # return best transcript and score
 
-def findOverlaps (list1, list2):
+def findOverlapCoords (starts1, ends1, starts2, ends2):
     '''
-    Given two lists of intervals, find the overlaps between them.  The
-    lists contain objects which have 'start' and 'end' attributes --
-    they need not be of the same type, or subclasses of each other.
+    Given two lists of intervals, find the overlaps between them. Each
+    list is given as parallel lists of start and end coordinates (see
+    exonCoords). The sweep only ever compares coordinates, so pulling
+    them out of the exon objects up front (once per read, and once
+    per transcript for the whole run) saves an attribute lookup on
+    every comparison.
 
     We return two arrays, one for each input list. There is an entry
     in the output array corresponding to each input list entry. The
@@ -321,26 +428,50 @@ def findOverlaps (list1, list2):
     and symmetrical.
     '''
 
-    over1 = [ [] for x in list1 ]
-    over2 = [ [] for x in list2 ]
+    # Many IsoSeq isoforms are single-exon. For those, two binary
+    # searches find the run of list2 entries the sweep below would
+    # have walked to: the first one which doesn't end before the
+    # exon starts, through the last one which starts before it ends.
+    # (Like the sweep, this relies on each list being in order and
+    # non-overlapping, as exons of one transcript are.)
+
+    if len(starts1) == 1:
+        first = bisect.bisect_left (ends2, starts1[0])
+        stop  = bisect.bisect_left (starts2, ends1[0], first)
+        over2 = [ [] for x in starts2 ]
+        for ix in xrange(first, stop):
+            over2[ix].append(0)
+        return [range(first, stop)], over2
+
+    over1 = [ [] for x in starts1 ]
+    over2 = [ [] for x in starts2 ]
+    len2  = len(starts2)
     pos2  = 0
 
-    for pos1 in xrange(len(list1)):     # for each list1 entry, find all list2 which overlap it
+    for pos1 in xrange(len(starts1)):   # for each list1 entry, find all list2 which overlap it
+
+        start1 = starts1[pos1]          # locals: these get compared on every step of the loops below
+        end1   = ends1[pos1]
+        hits1  = over1[pos1]
 
-        while pos2 < len(list2) and list2[pos2].end < list1[pos1].start:
+        while pos2 < len2 and ends2[pos2] < start1:
             pos2 += 1                   # we're done with this list2 entry
 
         ix = pos2                       # start from current list2 entry and look forward
-        while ix < len(list2) and list2[ix].start < list1[pos1].end:
-            over1[pos1].append(ix)
+        while ix < len2 and starts2[ix] < end1:
+            hits1.append(ix)
             over2[ix].append(pos1)
             ix += 1
 
-        pos1 += 1
-
     return over1, over2
 
 
+def exonCoords (exons):
+    '''Return lists of the start and end coordinates of a list of exons.'''
+
+    return [x.start for x in exons], [x.end for x in exons]
+
+
 def overlap2string (over1):
     '''Create a printable string representation of an overlap list.'''
 
@@ -382,44 +513,40 @@ def isMatch (over1, over2):
     if len(over1) != len(over2):
         return False
 
-    for ix in xrange(len(over1)):
-        if len(over1[ix]) != 1 or over1[ix][0] != ix:
+    ix = 0
+    for group in over1:
+        if group != [ix]:                  # must be exactly [ix]
             return False
+        ix += 1
 
     return True
 
 
-def internalMatch (list1, list2):
+def internalMatch (starts1, ends1, starts2, ends2):
     '''
     Given two lists of exon intervals which overlap one-for-one (as
     determined by isMatch), determine whether their coordinates match
     exactly, EXCEPT for the start of the first exon and the end of the
     last exon. That variation is currently thought to be caused (at
     the 3' end, at least) by polyadenylation at more sites than the
-    annotations record.
+    annotations record. The intervals are given as parallel lists of
+    start and end coordinates, as for findOverlapCoords.
     '''
-    
-    for ix in xrange(1,len(list1)):                    # check starts, skip exon 0
-        if list1[ix].start != list2[ix].start:
-            return False
 
-    for ix in xrange(len(list1)-1):                    # check ends, skip last exon
-        if list1[ix].end != list2[ix].end:
-            return False
+    # List comparison runs in C, and stops at the first difference.
 
-    return True
+    return starts1[1:] == starts2[1:] and ends1[:-1] == ends2[:-1]     # skip start of exon 0, end of last exon
 
 
-def showCoords (readExons, tranExons):
+def showCoords (readExons, tranExons, overR, overT):
     '''
-    Print coordinates of matched exons, given their interval
-    lists. Note that this only works when the exons match
-    one-for-one. The first list is assumed to also contain counts of
-    insertions and deletions.
+    Print coordinates of matched exons, given their interval lists
+    and the overlaps between them (as returned by findOverlapCoords). Note
+    that this only works when the exons match one-for-one. The first
+    list is assumed to also contain counts of insertions and
+    deletions.
     '''
 
-    overR, overT = findOverlaps (readExons, tranExons)      # already done in matchTranscripts, but easier to recompute than to save
-
     ixR = 0
     ixT = 0
 
@@ -511,13 +638,15 @@ def printStartStop (tranExons, exonT):
 def printClusterReads (clusterList, clusterName):
     '''Print full and partial read names which make up a cluster.'''
 
-    clusterID = re.search('(c\d+)', clusterName).group(1)      # isoform name format varies, but cnnnn should be in there somewhere
+    clusterID = regexClusterID.search(clusterName).group(1)
     for FL, cellNo, reads in clusterList.showReads(clusterID):
         flag = 'cl-FL:' if FL == 'FL' else 'cl-nfl:'           # shorten 'nonFL' to 'nfl'
-        for ix in xrange(0,len(reads),CL_PER_LINE):            # print N reads to the line
-            print '%-7s   %2d  ' % (flag, cellNo), '  '.join(['%-16s' % x for x in reads[ix:ix+CL_PER_LINE] ])
+        lead = '%-7s   %2d   ' % (flag, cellNo)                # same for every line of this cell
+        names = ['%-16s' % x for x in reads]
+        print '\n'.join([ lead + '  '.join(names[ix:ix+CL_PER_LINE])     # N reads to the line, one print for the lot
+                           for ix in xrange(0,len(names),CL_PER_LINE) ])
 
-def getParms ():                       # use default input sys.argv[1:]
+def getParms (argv=None):              # argv=None: use default input sys.argv[1:]
 
     parser = optparse.OptionParser(usage='%prog [options] <SAM_file> ... ', version=VERSION)
 
@@ -527,11 +656,13 @@ def getParms ():                       # use default input sys.argv[1:]
     parser.add_option ('--clusters',  help='cluster_report.csv file name (optional)')
     parser.add_option ('--vars',      help='print variants for each cluster (def: no)', action='store_true')
     parser.add_option ('--outpickle', help='matches in pickle format (optional)')
+    parser.add_option ('--procs',     help='number of processes to match isoforms with (def: %default)', type='int')
 
     parser.set_defaults (format='standard',
+                         procs=1,
                          )
 
-    opt, args = parser.parse_args()
+    opt, args = parser.parse_args(argv)
 
     return opt, args
 
@@ -8,12 +8,11 @@ import os
 import sys
 import optparse
 import re        # regular expressions
-import cPickle as pickle
 
 from tt_log import logger
 import Annotations as anno
 
-VERSION = '20150417.01'
+VERSION = '20261015.01'
 
 def main ():
 
@@ -22,10 +21,7 @@ def main ():
     opt, args = getParms()
 
     if opt.gtfpickle is not None:
-        handle = open (opt.gtfpickle, 'r')
-        pk = pickle.Unpickler (handle)
-        annotList = pk.load()
-        handle.close()
+        annotList = anno.AnnotationList.fromPickle (opt.gtfpickle)
     else:
         annotList   = anno.AnnotationList (opt.gtf)
 
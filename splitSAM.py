@@ -12,24 +12,30 @@ import sys
 import optparse
 import re        # regular expressions
 import string
+import heapq
+import subprocess
+import multiprocessing
 
 from tt_log import logger
 import CigarString as cs
 
-VERSION = '20150501.01'
+VERSION = '20261015.01'
 
 FLAG_NOT_ALIGNED = 0x04         # SAM file flags
 FLAG_REVERSE     = 0x10
 FLAG_SECONDARY   = 0x100
 
 FASTA_WRAP = 60
-BOWTIE_BUILD = '/is2/projects/pacbio/static/software/packages/bowtie2-2.2.3/bowtie2-build'
+BUFSIZE    = 1024 * 1024                             # output buffer size for fasta files
+COMPLTAB   = string.maketrans ('ACGT', 'TGCA')       # for reverse-complementing reads
+BOWTIE_BUILD = os.environ.get ('BOWTIE_BUILD',
+                               '/is2/projects/pacbio/static/software/packages/bowtie2-2.2.3/bowtie2-build')
 
-def main ():
+def main (argv=None):
 
     logger.debug('version %s starting' % VERSION)
 
-    opt, args = getParms()
+    opt, args = getParms(argv)
 
     if len(args) > 0:
         logger.debug('reading SAM file %s' % args[0])
@@ -45,7 +51,16 @@ def main ():
     fileSeq = 0
     fastaList = list()            # list of currently open output fasta files
 
-    compltab = string.maketrans ('ACGT', 'TGCA')         # for reverse-complementing reads
+    # Each read goes to the first-created file whose last read on
+    # this chr ends before the new read starts. Rather than scan every
+    # file for every read, keep two heaps: files whose last read may
+    # still overlap, ordered by where that read ends, and files known
+    # to fit, ordered by creation. Since reads arrive sorted, a file
+    # that fits keeps fitting until it's given another read.
+
+    curChr = None
+    busy   = list()               # heap of (end of last read, seq, fasta)
+    free   = list()               # heap of (seq, fasta)
 
     fastaNonAligned = tiledFasta ('%s.nonaligned.fasta' % opt.prefix)
 
@@ -56,7 +71,7 @@ def main ():
 
         totReads += 1
 
-        lineFields = line.split('\t')            # just split it once, not 6 times in list comp
+        lineFields = line.split('\t', 10)        # just split it once, not 6 times in list comp; tags stay unsplit
         readName, flags, chr, start, cigarString, bases = [lineFields[i] for i in (0,1,2,3,5,9)]
         flags = int(flags)
         start = int(start)
@@ -80,52 +95,76 @@ def main ():
         lastPos[chr] = start
 
         if strand == '-':
-            bases = bases[::-1].translate(compltab)
+            bases = bases[::-1].translate(COMPLTAB)
+
+        if chr != curChr:                        # new chr: rebuild the heaps from each file's position on it
+            curChr = chr
+            busy = [ (fasta.lastPos.get(chr, 0), fasta.seq, fasta) for fasta in fastaList ]
+            heapq.heapify(busy)
+            free = list()
 
-        found = False
-        for fasta in fastaList:
-            if fasta.fits (chr, start):
-                fasta.addRead (readName, chr, start, end, bases)
-                found = True
-                break
+        while len(busy) > 0 and busy[0][0] < start:     # these files now fit: see tiledFasta.fits
+            fastaEnd, seq, fasta = heapq.heappop(busy)
+            heapq.heappush(free, (seq, fasta))
 
-        if not found:
+        if len(free) > 0:
+            seq, fasta = heapq.heappop(free)
+        else:
             fileSeq += 1
-            fasta = tiledFasta ('%s.%03d.fasta' % (opt.prefix, fileSeq))
+            fasta = tiledFasta ('%s.%03d.fasta' % (opt.prefix, fileSeq), fileSeq)
             fastaList.append(fasta)
-            fasta.addRead (readName, chr, start, end, bases)
-            
+
+        fasta.addRead (readName, chr, start, end, bases)
+        heapq.heappush(busy, (end, fasta.seq, fasta))
+
     handle.close()
 
     fastaNonAligned.close()
     for fasta in fastaList:
         fasta.close()
-        fasta.makeRef()
+
+    # The bowtie2-build runs are independent of each other, and each
+    # is single-threaded, so run several at once.
+
+    names = [ fasta.name for fasta in fastaList ]
+    procs = min(opt.procs, len(names))
+    if procs > 1:
+        logger.debug('building %d references with %d processes' % (len(names), procs))
+        pool = multiprocessing.Pool (procs)
+        pool.map (buildRef, names, 1)
+        pool.close()
+        pool.join()
+    else:
+        for name in names:
+            buildRef (name)
 
     logger.debug('found %d reads, of which %d aligned, %d were f1p0', totReads, totAlign, totUnsup)
     logger.debug('finished')
 
 
-def getParms ():                       # use default input sys.argv[1:]
+def getParms (argv=None):              # argv=None: use default input sys.argv[1:]
 
     parser = optparse.OptionParser(usage='%prog [options] <SAM_file> ... ')
 
     parser.add_option ('--prefix', help='start of fasta file name (required)')
+    parser.add_option ('--procs',  help='number of bowtie2-build runs at a time (def: %default)', type='int')
 
     parser.set_defaults (prefix=None,
+                         procs=1,
                          )
 
-    opt, args = parser.parse_args()
+    opt, args = parser.parse_args(argv)
 
     return opt, args
 
 
 class tiledFasta (object):
 
-    def __init__ (self, name):
+    def __init__ (self, name, seq=0):
 
         self.name = name
-        self.handle = open (name, 'w')
+        self.seq  = seq               # creation order, for splitSAM's file choice
+        self.handle = open (name, 'w', BUFSIZE)
         self.lastPos = dict()
 
         logger.debug('opened %s' % name)
@@ -137,9 +176,13 @@ class tiledFasta (object):
     def addRead (self, readName, chr, start, end, bases):
 
         self.lastPos[chr] = end
-        self.handle.write ('>%s  %s  %d  %d\n' % (readName, chr, start, end))
-        for ix in xrange(0, len(bases), FASTA_WRAP):
-            self.handle.write (bases[ix:ix+FASTA_WRAP] + '\n')
+
+        # Wrap the sequence and write the whole record in one go,
+        # rather than one write call per line.
+
+        lines = [ bases[ix:ix+FASTA_WRAP] for ix in xrange(0, len(bases), FASTA_WRAP) ]
+        lines.append('')                                 # so join supplies the final newline
+        self.handle.write ('>%s  %s  %d  %d\n%s' % (readName, chr, start, end, '\n'.join(lines)))
 
     def close (self):
 
@@ -152,13 +195,24 @@ class tiledFasta (object):
         if not self.handle.closed:
             self.close()
 
-        command = '%s %s %s > %s.out 2>&1' % (BOWTIE_BUILD, self.name, self.name, self.name)
-        logger.debug(command)
+        buildRef (self.name)
+
+
+def buildRef (name):
+    '''Invoke bowtie-build on a closed fasta file. Output goes to name.out.'''
+
+    command = [BOWTIE_BUILD, name, name]
+    logger.debug('%s > %s.out 2>&1' % (' '.join(command), name))
 
-        buildOut = os.popen (command)      # this should return nothing, since we've redirected the output
-        rc = buildOut.close()
-        if rc is not None:
-            raise RuntimeError ('bowtie2-build failed: %d' % rc)
+    outHandle = open (name + '.out', 'w')
+    try:
+        rc = subprocess.call (command, stdout=outHandle, stderr=subprocess.STDOUT)
+    except OSError as ex:                 # e.g., BOWTIE_BUILD does not exist
+        raise RuntimeError ('cannot run bowtie2-build: %s: %s' % (BOWTIE_BUILD, ex))
+    finally:
+        outHandle.close()
+    if rc != 0:
+        raise RuntimeError ('bowtie2-build failed: %d' % rc)
 
 if __name__ == "__main__":
     main()
@@ -1,23 +1,44 @@
 #!/usr/bin/env python
 
-# Given a fasta file of reads-of-insert, qsub N trimPrimers jobs, each
-# of which will process a subset of the file. Combine the outpts when
-# all are done.
+# Given a fasta file of reads-of-insert, submit N trimPrimers jobs to
+# PBS or SLURM, each of which will process a subset of the file.
+# Combine the outpts when all are done.
 
 import os
 import sys
 import optparse
 import re        # regular expressions
-import datetime
+import mmap
+import tempfile
+import shutil
+import subprocess
+import multiprocessing
 
 from tt_log import logger
 
-VERSION = '20150403.01'
+VERSION = '20261015.01'
 
 DEF_NJOBS = 16
 DEF_TMPDIR = 'tmp'
+DEF_BACKEND = 'pbs'
 
-STARTWAIT = 30                       # seconds to delay start of qsub'd jobs
+BUFSIZE   = 4 * 1024 * 1024          # bytes per write when copying chunks
+
+# Templates for the generated shell scripts.
+
+SCRIPT_HEADER = '#!/bin/bash\n\nset -o errexit\nset -o nounset\n\n'
+
+CHUNK_SCRIPT = SCRIPT_HEADER + '''~/work/MatchAnnot/trimPrimers.py \\
+    --input %(input)s \\
+    --primers %(primers)s \\
+%(report)s    > %(output)s
+'''
+
+ARRAY_SCRIPT = SCRIPT_HEADER + '''scripts=(
+%(scripts)s)
+
+exec bash ${scripts[$%(taskvar)s-1]}
+'''
 
 def main ():
 
@@ -25,142 +46,290 @@ def main ():
 
     opt, args = getParms()
 
-    makeTempDir (opt.tmpdir)
+    opt.tmpdir = makeTempDir (opt.tmpdir)
+
+    # Until the chunk jobs are queued, nothing else refers to the run
+    # directory, so if anything goes wrong before then, remove it
+    # rather than leave an empty or half-written one behind.
+
+    try:
+        chunkList = makeFastaChunks (opt)
+
+        for chunk in chunkList:
+            chunk.makeScript()
 
-    nSeqs = countSeqs (opt.input)
-    logger.debug('%s contains %d sequences' % (opt.input, nSeqs))
+        # Dependent job submission will fail if the parent has already
+        # completed. So the array is submitted on hold, and released only
+        # once the final job depending on it is queued. If that fails,
+        # cancel the array rather than leave it held in the queue.
 
-    seqsPerJob = (nSeqs + opt.njobs - 1) / opt.njobs
-    logger.debug('each of %d jobs will process %d sequences' % (opt.njobs, seqsPerJob))
+        arrayJobno = submitChunkJobs (opt, chunkList)
+    except BaseException:
+        excInfo = sys.exc_info()
+        shutil.rmtree (opt.tmpdir, ignore_errors=True)
+        raise excInfo[0], excInfo[1], excInfo[2]
 
-    chunkList = makeFastaChunks (opt, nSeqs, seqsPerJob)
+    logger.info('temporary files, including the final job\'s trim_final.out, are in %s' % opt.tmpdir)
 
-    for chunk in chunkList:
-        chunk.makeScript()
-        chunk.submitScript()
+    finalJobno = None
+    try:
+        finalJobno = submitFinalJobs (opt, chunkList, arrayJobno)
+        releaseJob (opt, arrayJobno)
+    except BaseException:
 
-    submitFinalJobs (opt, chunkList)
+        # Cancel whatever was queued. A failure to cancel is only
+        # logged, so that the error re-raised is the one that got us
+        # here.
+
+        excInfo = sys.exc_info()
+        for jobno in (finalJobno, arrayJobno):
+            if jobno is None:
+                continue
+            logger.error('job submission failed, cancelling job %s' % jobno)
+            try:
+                cancelJob (opt, jobno)
+            except Exception as ex:
+                logger.error('could not cancel job %s: %s' % (jobno, ex))
+        raise excInfo[0], excInfo[1], excInfo[2]
 
     logger.debug('finished')
 
     return
 
 def makeTempDir (dir):
+    '''Make a new, uniquely named directory for this run under dir. Return its name.'''
 
-    if os.path.isdir (dir):
-        logger.warning('WARNING: temp directory %s already exists' % dir)
-    else:
+    # Chunk file names are the same from run to run, so two runs
+    # sharing one directory would overwrite each other's files.
+
+    if not os.path.isdir (dir):
         os.makedirs (dir)
-        
-    return
 
-def countSeqs (filename):
-    '''Run grep -c ">" on a fasta file to count the sequences it contains.'''
+    runDir = tempfile.mkdtemp (prefix='trim_', dir=dir)
 
-    command = 'grep -c ">" %s' % filename
-    popen_file = os.popen(command)
-    response = popen_file.read().strip()
-    rc       = popen_file.close()
-    if rc is not None:
-        logger.error("command failed, rc=%d" % rc)
-        raise RuntimeError
-    if not response.isdigit():
-        logger.error("grep -c returned:" % response)
-        raise RuntimeError
-    
-    return int(response)
+    # mkdtemp makes the directory private. Give it the mode os.makedirs
+    # would have, so the user's umask decides who can read it.
 
-def makeFastaChunks (opt, nSeqs, seqsPerJob):
+    umask = os.umask (0)
+    os.umask (umask)
+    os.chmod (runDir, 0777 & ~umask)
 
-    curPos = 1
-    thisRec = 0
-    chunkList = list()
+    return runDir
 
-    fastaIn = open (opt.input, 'r')
-    line = fastaIn.readline()
-    if not line.startswith('>'):
-        raise RuntimeError ('first fasta line is not a header: %s' % line)
+def makeFastaChunks (opt):
+    '''Split the input fasta file into at most opt.njobs chunk files of about equal size.'''
 
-    while (line):                               # outer loop reads the whole input file
+    # Cut the file at evenly spaced byte offsets, each moved forward
+    # to the start of the next header. That takes one find per chunk,
+    # rather than a pass over the whole file to count sequences first.
 
-        endPos = min(curPos+seqsPerJob-1, nSeqs)
-        fastaChunk = Chunk (opt, curPos, endPos)
-        logger.debug('writing chunk %s' % fastaChunk.inputChunkName)
-        with open (fastaChunk.inputChunkName, 'w') as chunkOut:
+    with open (opt.input, 'rb') as handle:
 
-            while (line):                       # inner loop writes one chunk
+        if os.fstat(handle.fileno()).st_size == 0:
+            raise RuntimeError ('fasta file %s is empty' % opt.input)
 
-                if line.startswith('>'):
+        mm = mmap.mmap (handle.fileno(), 0, access=mmap.ACCESS_READ)
+        if mm[0] != '>':
+            raise RuntimeError ('first fasta line is not a header: %s' % mm[:mm.find('\n')])
 
-                    thisRec += 1
-                    if thisRec > seqsPerJob:
-                        chunkList.append(fastaChunk)
-                        thisRec = 0
-                        break                   # break inner loop and exit with block, closing output file
+        fileSize = len(mm)
+        chunkBytes = (fileSize + opt.njobs - 1) // opt.njobs
+        logger.debug('%s is %d bytes, about %d per job' % (opt.input, fileSize, chunkBytes))
 
-                    curPos += 1
+        bounds = [0]
+        for ix in xrange(1, opt.njobs):
+            target = max(ix*chunkBytes, bounds[-1]+1)    # one long sequence can span several targets
+            pos = mm.find ('\n>', target-1)
+            if pos < 0:
+                break
+            bounds.append (pos+1)
+        bounds.append (fileSize)
 
-                chunkOut.write (line)
-                line = fastaIn.readline()
+        mm.close()
 
-    if thisRec > 0:
-        chunkList.append(fastaChunk)
+    chunkList = list()
+    slices = list()
 
-    fastaIn.close()
+    for ix in xrange(len(bounds)-1):
+        fastaChunk = Chunk (opt, ix+1, bounds[ix], bounds[ix+1])
+        chunkList.append(fastaChunk)
+        slices.append((opt.input, fastaChunk.inputChunkName, fastaChunk.start, fastaChunk.end))
+
+    # Each chunk is an independent byte range of the input, so several
+    # can be copied at once.
+
+    procs = min(opt.procs, len(slices))
+    if procs > 1:
+        logger.debug('writing %d chunks with %d processes' % (len(slices), procs))
+        pool = multiprocessing.Pool (procs)
+        pool.map (copySlice, slices, 1)
+        pool.close()
+        pool.join()
+    else:
+        for piece in slices:
+            copySlice (piece)
 
     return chunkList
 
-def submitFinalJobs (opt, chunkList):
+def copySlice (piece):
+    '''Copy bytes [start, end) of a file to a new file.'''
 
-    chunkFiles = ['%s \\\n' % chk.trimmedChunkName for chk in chunkList]
+    inName, outName, start, end = piece
+    logger.debug('writing chunk %s' % outName)
 
-    sh = list()
-    sh.append('#!/bin/bash\n\n')
-    sh.append('set -o errexit\n')
-    sh.append('set -o nounset\n\n')
+    with open (inName, 'rb') as handle:
+        mm = mmap.mmap (handle.fileno(), 0, access=mmap.ACCESS_READ)
+        with open (outName, 'wb') as chunkOut:
+            for pos in xrange(start, end, BUFSIZE):
+                chunkOut.write (mm[pos:min(pos+BUFSIZE, end)])
+        mm.close()
+
+    return
+
+def submitChunkJobs (opt, chunkList):
+    '''Submit all the chunk scripts as one job array. Return its job number.'''
+
+    # One qsub for the whole array rather than one per chunk. Each
+    # array task uses its index to pick its chunk's script.
+
+    scripts = ''.join(['%s\n' % chk.scriptName for chk in chunkList])
+    taskvar = 'SLURM_ARRAY_TASK_ID' if opt.backend == 'slurm' else 'PBS_ARRAYID'
+
+    arrayScriptName = '%s/trim_array.sh' % opt.tmpdir
+    handle =  open (arrayScriptName, 'w')
+    handle.write (ARRAY_SCRIPT % {'scripts' : scripts, 'taskvar' : taskvar})
+    handle.close()
+
+    if opt.backend == 'slurm':
+        cmd = list()
+        cmd.append('sbatch')
+        cmd.append('--parsable')                         # print just the job number
+        cmd.extend(['--job-name', 'trim_array'])         # job name
+        cmd.extend(['--array', '1-%d' % len(chunkList)]) # one array task per chunk
+        cmd.extend(['--output', '%s/trim_array.out-%%a' % opt.tmpdir])  # output file, stdout and stderr, per task
+        cmd.extend(['--nodes', '1', '--ntasks', '1', '--time', '4:00:00'])  # resources required
+        cmd.append('--hold')                             # hold until released, see main
+        cmd.append('--no-requeue')                       # do NOT attempt to restart on failure
+        cmd.append('--export=ALL')                       # export all environment variables to job
+        cmd.append(arrayScriptName)                      # script to run
+        return submitJob (cmd)
+
+    cmd = list()
+    cmd.append('qsub')
+    cmd.extend(['-N', 'trim_array'])                 # job name
+    cmd.extend(['-t', '1-%d' % len(chunkList)])      # one array task per chunk
+    cmd.extend(['-o', '%s/trim_array.out' % opt.tmpdir])  # output file, PBS appends -<task>
+    cmd.extend(['-j', 'oe'])                         # combine stdout and stderr
+    cmd.extend(['-l', 'nodes=1:ppn=1,walltime=4:00:00'])  # resources required
+    cmd.append('-h')                                 # hold until released, see main
+    cmd.extend(['-d', '.'])                          # working directory (strangely, ./ is not the default)
+    cmd.extend(['-r', 'n'])                          # do NOT attempt to restart on failure
+    cmd.append('-V')                                 # export all environment variables to job
+    cmd.extend(['-W', 'umask=0002'])                 # make logs rw-rw-r--
+    cmd.extend(['-m', 'n'])                          # don't send any mail
+    cmd.append(arrayScriptName)                      # script to run
+
+    return submitJob (cmd)
+
+def submitFinalJobs (opt, chunkList, arrayJobno):
+
+    # The dependency must name the array by job number, never by job
+    # name: a stale trim_array from an earlier run may still be queued.
+
+    if opt.backend == 'slurm':
+        isArray = arrayJobno is not None and arrayJobno.isdigit()
+    else:
+        isArray = arrayJobno is not None and arrayJobno.endswith('[]')
+    if not isArray:
+        raise RuntimeError ('not an array job number: %s' % arrayJobno)
 
-    sh.append('cat \\\n')
-    sh.extend(chunkFiles)
-    sh.append(' > %s\n' % opt.output)
+    sh = list()
+    sh.append(SCRIPT_HEADER)
+    sh.append('cat %s > %s\n' % (' '.join([chk.trimmedChunkName for chk in chunkList]), opt.output))
 
     if opt.report is not None:
-        reportFiles = ['%s \\\n' % chk.reportChunkName for chk in chunkList]
-        sh.append('\ncat \\\n')
-        sh.extend(reportFiles)
-        sh.append(' > %s\n' % opt.report)
+        sh.append('cat %s > %s\n' % (' '.join([chk.reportChunkName for chk in chunkList]), opt.report))
 
     finalScriptName = '%s/trim_final.sh' % opt.tmpdir
     handle =  open (finalScriptName, 'w')
     handle.writelines (sh)
     handle.close()
 
-    deps = ':'.join ([chk.jobno for chk in chunkList])
+    if opt.backend == 'slurm':
+        cmd = list()
+        cmd.append('sbatch')
+        cmd.append('--parsable')                         # print just the job number
+        cmd.extend(['--job-name', 'trim_final'])         # job name
+        cmd.extend(['--output', '%s/trim_final.out' % opt.tmpdir])  # output file, stdout and stderr
+        cmd.extend(['--nodes', '1', '--ntasks', '1', '--time', '4:00:00'])  # resources required
+        cmd.append('--no-requeue')                       # do NOT attempt to restart on failure
+        cmd.append('--export=ALL')                       # export all environment variables to job
+        cmd.extend(['--dependency', 'afterok:%s' % arrayJobno])
+        cmd.append(finalScriptName)                      # script to run
+        return submitJob (cmd)
 
     cmd = list()
     cmd.append('qsub')
-    cmd.append('-N trim_final')       # job name
-    cmd.append('-o trim_final.out')   # output file
-    cmd.append('-j oe')               # combine stdout and stderr
-    cmd.append('-l nodes=1:ppn=1,walltime=4:00:00')    # resources required
-    cmd.append('-d . ')               # working directory (strangely, ./ is not the default)
-    cmd.append('-r n')                # do NOT attempt to restart on failure
-    cmd.append('-V')                  # export all environment variables to job
-    cmd.append('-W umask=0002')       # make logs rw-rw-r--
-    cmd.append('-m n')                # don't send any mail
-    cmd.append('-W depend=afterok:%s' % deps)
-    cmd.append(finalScriptName)       # script to run
-
-    command = ' '.join(cmd)
-    logger.debug ('running %s' % command)
-    
-    popen_file = os.popen(command)
-    response = popen_file.read().strip()
-    rc = popen_file.close()
-    if rc is not None:
-        logger.error('command failed, rc=%d' % rc)
+    cmd.extend(['-N', 'trim_final'])                 # job name
+    cmd.extend(['-o', '%s/trim_final.out' % opt.tmpdir])  # output file
+    cmd.extend(['-j', 'oe'])                         # combine stdout and stderr
+    cmd.extend(['-l', 'nodes=1:ppn=1,walltime=4:00:00'])  # resources required
+    cmd.extend(['-d', '.'])                          # working directory (strangely, ./ is not the default)
+    cmd.extend(['-r', 'n'])                          # do NOT attempt to restart on failure
+    cmd.append('-V')                                 # export all environment variables to job
+    cmd.extend(['-W', 'umask=0002'])                 # make logs rw-rw-r--
+    cmd.extend(['-m', 'n'])                          # don't send any mail
+    cmd.extend(['-W', 'depend=afterokarray:%s' % arrayJobno])
+    cmd.append(finalScriptName)                      # script to run
+
+    return submitJob (cmd)
+
+def submitJob (cmd):
+    '''Run a qsub or sbatch command. Return the job number it reports.'''
+
+    response = submit (cmd)
+
+    match = Chunk.JOBNO_PATTERN.match (response)
+    if match is None:
+        logger.error("invalid job sequence number: %s" % response)
         raise RuntimeError
 
+    response = match.group(1)
     logger.debug ('jobno is %s' % response)
+    return response
+
+def releaseJob (opt, jobno):
+    '''Release a job submitted on hold.'''
+
+    if opt.backend == 'slurm':
+        submit (['scontrol', 'release', jobno])
+    else:
+        submit (['qrls', jobno])
+
+    return
+
+def cancelJob (opt, jobno):
+    '''Delete a job from the queue.'''
+
+    if opt.backend == 'slurm':
+        submit (['scancel', jobno])
+    else:
+        submit (['qdel', jobno])
+
+    return
+
+def submit (cmd):
+    '''Run a scheduler command, given as an argument list. Return what it writes to stdout.'''
+
+    # No shell in between, so nothing in the arguments needs quoting.
+
+    logger.debug ('running %s' % ' '.join(cmd))
+
+    proc = subprocess.Popen (cmd, stdout=subprocess.PIPE)
+    response = proc.communicate()[0].strip()
+    if proc.returncode != 0:
+        logger.error('command failed, rc=%d' % proc.returncode)
+        raise RuntimeError
 
     return response
 
@@ -172,11 +341,15 @@ def getParms ():                       # use default input sys.argv[1:]
     parser.add_option ('--primers', help='fasta file of primers (required)')
     parser.add_option ('--output',  help='output fasta file (required)')
     parser.add_option ('--report',  help='output alignments report text file (optional)')
-    parser.add_option ('--njobs',   help='number of jobs to submit (def: %default)', type='int')
-    parser.add_option ('--tmpdir',  help='temporary directory (def: %default)')
+    parser.add_option ('--njobs',   help='maximum number of jobs to submit; fewer if chunks would split a sequence (def: %default)', type='int')
+    parser.add_option ('--tmpdir',  help='directory to make each run\'s temporary directory in; chunk files and job logs, including trim_final.out, go there (def: %default)')
+    parser.add_option ('--procs',   help='number of chunk files to write at a time (def: %default)', type='int')
+    parser.add_option ('--backend', help='batch system, pbs or slurm (def: %default)', type='choice', choices=['pbs', 'slurm'])
 
     parser.set_defaults (njobs=DEF_NJOBS,
                          tmpdir=DEF_TMPDIR,
+                         backend=DEF_BACKEND,
+                         procs=1,
                          )
 
     opt, args = parser.parse_args()
@@ -187,86 +360,40 @@ def getParms ():                       # use default input sys.argv[1:]
 class Chunk (object):
     '''Manage a chunk, including keeping all the file names consistent and in one place.'''
 
-    JOBNO_PATTERN = re.compile('^(\d+)')  # the number part of job number
+    JOBNO_PATTERN = re.compile('^(\d+(\[\])?)')  # the number part of job number, with [] if a PBS array
 
-    def __init__ (self, opt, start, end):
+    def __init__ (self, opt, number, start, end):
 
         self.opt   = opt
-        self.start = start
+        self.start = start    # byte range of the input file
         self.end   = end
-        self.jobno = None     # filled in when submitted
-        self.jobName          = 'trim.%06d'                        % (start)
-        self.scriptName       = '%s/trim.%06d_%06d.sh'             % (opt.tmpdir, start, end)
-        self.scriptOutput     = '%s/trim.%06d_%06d.out'            % (opt.tmpdir, start, end)
-        self.inputChunkName   = '%s/input_chunk.%06d_%06d.fasta'   % (opt.tmpdir, start, end)
-        self.trimmedChunkName = '%s/trimmed_chunk.%06d_%06d.fasta' % (opt.tmpdir, start, end)
+
+        sfx = '%06d' % number                 # common to all of this chunk's files
+
+        self.scriptName       = '%s/trim.%s.sh'             % (opt.tmpdir, sfx)
+        self.inputChunkName   = '%s/input_chunk.%s.fasta'   % (opt.tmpdir, sfx)
+        self.trimmedChunkName = '%s/trimmed_chunk.%s.fasta' % (opt.tmpdir, sfx)
         if opt.report is None:
             self.reportChunkName  = None
         else:
-            self.reportChunkName  = '%s/report_chunk.%06d_%06d.txt'  % (opt.tmpdir, start, end)
+            self.reportChunkName  = '%s/report_chunk.%s.txt'  % (opt.tmpdir, sfx)
 
     def makeScript (self):
 
-        sh = list()
-        sh.append('#!/bin/bash\n\n')
-        sh.append('set -o errexit\n')
-        sh.append('set -o nounset\n\n')
-        sh.append('~/work/MatchAnnot/trimPrimers.py \\\n')
-        sh.append('    --input %s \\\n' % self.inputChunkName)
-        sh.append('    --primers %s \\\n' % self.opt.primers)
-
-        if self.opt.report is not None:
-            sh.append('    --report %s \\\n' % self.reportChunkName)
-            
-        sh.append('    > %s\n' % self.trimmedChunkName)
+        if self.opt.report is None:
+            report = ''
+        else:
+            report = '    --report %s \\\n' % self.reportChunkName
 
         handle =  open (self.scriptName, 'w')
-        handle.writelines (sh)
+        handle.write (CHUNK_SCRIPT % {'input'   : self.inputChunkName,
+                                      'primers' : self.opt.primers,
+                                      'report'  : report,
+                                      'output'  : self.trimmedChunkName,
+                                      })
         handle.close()
 
         return
 
-    def submitScript (self):
-
-        # Dependent job submission will fail if parent has already
-        # completed. So delay all job startups by a short amount of time.
-
-        startAt = datetime.datetime.now() + datetime.timedelta(0, STARTWAIT)
-        startAtStr = startAt.strftime('%Y%m%d%H%M.%S')
-
-        cmd = list()
-        cmd.append('qsub')
-        cmd.append('-N %s' % self.jobName)           # job name
-        cmd.append('-o %s' % self.scriptOutput)      # output file
-        cmd.append('-j oe')               # combine stdout and stderr
-        cmd.append('-l nodes=1:ppn=1,walltime=4:00:00')    # resources required
-        cmd.append('-a %s' % startAtStr)  # delay start, see above
-        cmd.append('-d . ')               # working directory (strangely, ./ is not the default)
-        cmd.append('-r n')                # do NOT attempt to restart on failure
-        cmd.append('-V')                  # export all environment variables to job
-        cmd.append('-W umask=0002')       # make logs rw-rw-r--
-        cmd.append('-m n')                # don't send any mail
-        cmd.append(self.scriptName)       # script to run
-
-        command = ' '.join(cmd)
-        logger.debug ('running %s' % command)
-        
-        popen_file = os.popen(command)
-        response = popen_file.read().strip()
-        rc = popen_file.close()
-        if rc is not None:
-            logger.error('command failed, rc=%d' % rc)
-            raise RuntimeError
-
-        match = re.match (Chunk.JOBNO_PATTERN, response)
-        if match is None:
-            logger.error("invalid job sequence number: %s" % jobSeqStr)
-            raise RuntimeError
-
-        response = match.group(1)
-        logger.debug ('jobno is %s' % response)
-        self.jobno = response
-        return response
-
 if __name__ == "__main__":
     main()